@@ -0,0 +1,6 @@
+from pathlib import Path
+from dotenv import load_dotenv
+
+# 整個 app 只在這裡讀一次 .env；db.py、storage.py、main.py 被 import 之前一定會先跑到這裡
+BASE_DIR = Path(__file__).resolve().parents[2]  # msgboard
+load_dotenv(BASE_DIR / ".env")
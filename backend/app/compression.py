@@ -0,0 +1,37 @@
+import re
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+
+_GZIP_TAG = re.compile(r'-gzip"') # ETag 值結尾（右引號前）的 -gzip
+
+# GZipMiddleware 壓縮後 body 的 bytes 就變了，強 ETag 也要跟著變，不然 gzip 版跟原始版會共用同一個 ETag
+# 回應被壓縮時在 ETag 後面加上 -gzip；請求帶 If-None-Match 進來時先把 -gzip 拿掉，app 裡的 ETag 比對就不用知道有沒有壓縮
+class ETagGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await super().__call__(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        if_none_match = request_headers.get("if-none-match", "")
+        sent_gzip_tag = _GZIP_TAG.search(if_none_match) is not None
+        if sent_gzip_tag:
+            scope = dict(scope)
+            scope["headers"] = [
+                (name, _GZIP_TAG.sub('"', value.decode("latin-1")).encode("latin-1")) if name == b"if-none-match" else (name, value)
+                for name, value in scope["headers"]
+            ]
+
+        async def send_with_etag(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                etag = headers.get("etag")
+                if etag and etag.endswith('"'):
+                    gzipped = headers.get("content-encoding") == "gzip"
+                    # 304 沒有 body 不會被壓縮，但它代表的是客戶端手上那份 gzip 版，ETag 要跟當初 200 回的一樣
+                    gzip_not_modified = message["status"] == 304 and sent_gzip_tag and "gzip" in request_headers.get("accept-encoding", "")
+                    if gzipped or gzip_not_modified:
+                        headers["etag"] = etag[:-1] + '-gzip"'
+            await send(message)
+
+        await super().__call__(scope, receive, send_with_etag)
@@ -1,47 +1,58 @@
 import os
-from dotenv import load_dotenv
-import mysql.connector.pooling
-
-load_dotenv()
+import aiomysql
 
 DB_HOST = os.getenv("DB_HOST", "127.0.0.1")
 DB_PORT = int(os.getenv("DB_PORT", "3306"))
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 DB_NAME = os.getenv("DB_NAME", "anon_board")
+# 每個 worker 的連線池上限；MySQL 的 max_connections 要 ≥ workers × DB_POOL_SIZE
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "25"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # 連線閒置超過幾秒就換新的，避免拿到被 MySQL 斷掉的舊連線
+
+_pool = None # 連線池要在 event loop 裡建立，所以在 startup 時才由 init_pool() 建好
+
+async def init_pool():
+    global _pool
+    _pool = await aiomysql.create_pool(
+        minsize=min(5, DB_POOL_SIZE),
+        maxsize=DB_POOL_SIZE,
+        pool_recycle=DB_POOL_RECYCLE,
+        host=DB_HOST,
+        port=DB_PORT,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        db=DB_NAME,
+        charset="utf8mb4",
+        # 只有 SELECT 的請求不會 commit；autocommit 關著的話連線會停在交易中，還回連線池時 aiomysql 會直接把它關掉，
+        # 每個請求都要重新連線，而且 REPEATABLE READ 會一直看到舊的快照
+        autocommit=True,
+        # session 時區固定成 UTC：TIMESTAMP 讀寫都用 UTC，跟 app 主機、MySQL 主機各自的時區設定無關
+        init_command="SET NAMES utf8mb4 COLLATE utf8mb4_unicode_ci, time_zone = '+00:00'",
+    )
 
-_pool = mysql.connector.pooling.MySQLConnectionPool(
-    pool_name="anon_board_pool",
-    pool_size=5,
-    pool_reset_session=True,
-    host=DB_HOST,
-    port=DB_PORT,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    database=DB_NAME,
-    charset="utf8mb4",
-    collation="utf8mb4_unicode_ci",
-)
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        await _pool.wait_closed() # 等所有連線都確實關閉
+        _pool = None
 
 def get_connection():
-    con = _pool.get_connection() # 從連線池取出一條連線
-    con.ping(reconnect=True) # 確認連線活著，斷線就自動重連
-    return con
+    # 回傳 async context manager：async with get_connection() as con: ...，離開區塊時自動把連線還回連線池
+    return _pool.acquire()
 
-def init_db():
-    con = get_connection()
-    try:
-        cur = con.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS posts (
-              id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
-              message TEXT NOT NULL,
-              image_key VARCHAR(1024) NULL,
-              created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
-            """
-        )
-        con.commit()
-    finally:
-        con.close()
\ No newline at end of file
+async def init_db():
+    async with get_connection() as con:
+        async with con.cursor() as cur:
+            await cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS posts (
+                  id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                  message TEXT NOT NULL,
+                  image_key VARCHAR(1024) NULL,
+                  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """
+            )
+        await con.commit()
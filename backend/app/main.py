@@ -1,22 +1,53 @@
 import os
+import asyncio
+import contextlib
+import hashlib
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from typing import Optional # 用來表示某些欄位「可以是 None / 可以不填」
-from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from starlette.routing import Route
 from pydantic import BaseModel, Field # 用來定義 request body 的資料結構與欄位驗證規則
-from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 
-from .db import init_db, get_connection
-from .storage import create_presigned_post, create_presigned_get
+from .db import init_pool, close_pool, get_connection
+from .compression import ETagGZipMiddleware
+from .static import CachedStatic
+from .storage import S3_BUCKET, check_config, create_presigned_post, create_presigned_get
 
-load_dotenv()
+# app 的生命週期：yield 之前是啟動（每個 worker 各跑一次），yield 之後是關閉
+# 建表改由 app/migrate.py 在啟動 workers 之前跑一次，避免多個 worker 同時建表
+@contextlib.asynccontextmanager
+async def _lifespan(app: FastAPI):
+    check_config() # S3 設定有缺就先在 log 警告
+    await init_pool() # 建立 aiomysql 連線池
+    # 簽 URL 專用的 threadpool；每次啟動都建新的，關閉之後下一次啟動還能用
+    # 在 worker 啟動時才建立，所以 gunicorn --preload fork 之前不會有 thread
+    app.state.sign_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="presign")
 
-app = FastAPI() # 建立 FastAPI app 實例，後面會在它上面掛路由
+    # 沒串 CDN 時，在背景先幫最新的貼文簽好圖片 URL，list_posts 只要查快取
+    app.state.presign_refresher = None
+    if S3_BUCKET and not os.getenv("CDN_DOMAIN", "").strip():
+        app.state.presign_refresher = asyncio.create_task(_presign_refresher())
 
-# 註冊一個「啟動事件」，當 FastAPI 啟動完成後會呼叫這個函式
-@app.on_event("startup")
-def _startup():
-    init_db() # 啟動時初始化資料庫（如果表格已經存在就不會重建）
+    try:
+        yield
+    finally:
+        if app.state.presign_refresher is not None:
+            app.state.presign_refresher.cancel()
+            # 等背景工作真的停下來，再關連線池；不然它可能還在用連線，loop 結束時也會警告 task 沒跑完
+            with contextlib.suppress(asyncio.CancelledError):
+                await app.state.presign_refresher
+        await close_pool()
+        app.state.sign_pool.shutdown(wait=False)
+
+app = FastAPI(lifespan=_lifespan) # 建立 FastAPI app 實例，後面會在它上面掛路由
+app.add_middleware(ETagGZipMiddleware, minimum_size=500, compresslevel=5) # 超過 500 bytes 的回應（貼文列表 JSON、html/css/js）用 gzip 壓縮，壓縮版的 ETag 會加上 -gzip
+logger = logging.getLogger(__name__)
 
 # 定義 Request body 的資料結構
 # for /api/presign
@@ -30,23 +61,126 @@ class PostCreateIn(BaseModel):
     message: str = Field(..., min_length=1, max_length=2000)
     image_key: Optional[str] = None
 
-# 把 DB 裡存的 image_key，轉成前端能放在 <img src="..."> 的 image_url
-def _build_image_url(image_key: Optional[str]) -> Optional[str]:
+# 定義 Response 的資料結構
+# 有 response_model 時，FastAPI 直接用 pydantic-core（Rust）把回傳值序列化成 JSON bytes，不用先 jsonable_encoder 再 json.dumps
+class PostOut(BaseModel):
+    id: int
+    message: str
+    image_url: Optional[str] = None
+    created_at: datetime # 一律是 UTC 且帶時區資訊，序列化成 ISO 8601 字串（結尾是 Z）
+
+class PostListOut(BaseModel):
+    data: list[PostOut]
+
+# 同一個 image_key 在同一個時間區間內重複使用同一組 presigned URL，不用每次都重新簽章
+# bucket 是「目前第幾個 expires/2 秒的區間」，換區間就會重簽，所以發出去的 URL 至少還有一半的有效時間
+SIGNED_URL_CACHE_SIZE = 4096
+_signed_urls = OrderedDict() # image_key -> (expires, bucket, url)；每個區間都會重簽一次，所以照「最後簽的時間」淘汰最舊的就好
+_signed_urls_lock = threading.Lock() # 簽章在 threadpool 裡跑，寫入快取要上鎖；讀取不用
+
+# 只查快取、不簽章，event loop 上也可以直接呼叫
+def _cached_signed_get(image_key: str, expires: int, bucket: int) -> Optional[str]:
+    hit = _signed_urls.get(image_key)
+    if hit is not None and hit[:2] == (expires, bucket):
+        return hit[2]
+    return None
+
+def _signed_get(image_key: str, expires: int, bucket: int) -> str:
+    url = _cached_signed_get(image_key, expires, bucket)
+    if url is None:
+        url = create_presigned_get(image_key, expires_in=expires)
+        with _signed_urls_lock:
+            _signed_urls[image_key] = (expires, bucket, url)
+            _signed_urls.move_to_end(image_key)
+            if len(_signed_urls) > SIGNED_URL_CACHE_SIZE:
+                _signed_urls.popitem(last=False)
+    return url
+
+def _url_bucket(expires: int) -> int:
+    return int(time.time()) // max(1, expires // 2)
+
+# 組 image_url 需要的設定：CDN 網域、presigned URL 有效秒數、目前的區間
+def _image_url_settings():
+    expires = int(os.getenv("VIEW_EXPIRES_IN", "3600"))
+    return os.getenv("CDN_DOMAIN", "").strip(), expires, _url_bucket(expires)
+
+_NOT_CACHED = object() # 代表「一定要簽章才拿得到 URL」
+
+# 不用簽章就能決定的情況（沒圖片、有 CDN、快取裡已經有）直接算好；真的要簽章才回 _NOT_CACHED
+def _image_url_without_signing(image_key: Optional[str], cdn: str, expires: int, bucket: int):
     # 沒圖片就回 None，前端就不渲染 <img>
     if not image_key:
         return None
-    
-    # 有 CloudFront 就直接回 CDN URL（不需要 presigned GET）
-    cdn = os.getenv("CDN_DOMAIN", "").strip()
+
+    # 有 CloudFront 就直接回 CDN URL（不需要 presigned GET），正式環境建議走這條路
     if cdn:
         return f"https://{cdn}/{image_key}"
-    
+
     # CloudFront 還沒串好前，先回一個「暫時可讀」的 presigned GET URL，讓使用者能預覽私有 S3 物件
-    expires = int(os.getenv("VIEW_EXPIRES_IN", "3600"))
-    try:
-        return create_presigned_get(image_key, expires_in=expires)
-    except Exception: # 如果 S3 設定/憑證有問題，回 None 讓前端不顯示圖片
-        return None
+    url = _cached_signed_get(image_key, expires, bucket)
+    return _NOT_CACHED if url is None else url
+
+def _sign_image_urls(image_keys: list, expires: int, bucket: int) -> list:
+    urls = []
+    for key in image_keys:
+        try:
+            urls.append(_signed_get(key, expires, bucket))
+        except Exception: # 如果 S3 設定/憑證有問題，回 None 讓前端不顯示圖片
+            urls.append(None)
+    return urls
+
+# 把 DB 裡存的 image_key，轉成前端能放在 <img src="..."> 的 image_url（同步版，在 threadpool 裡用）
+def _build_image_url(image_key: Optional[str]) -> Optional[str]:
+    cdn, expires, bucket = _image_url_settings()
+    url = _image_url_without_signing(image_key, cdn, expires, bucket)
+    if url is _NOT_CACHED:
+        return _sign_image_urls([image_key], expires, bucket)[0]
+    return url
+
+# 沒圖片、CDN、快取命中都直接在 event loop 上處理；只有快取沒有的才簽章
+# 要簽的整批丟進 threadpool 一次簽完：botocore 簽章大多時間拿著 GIL，拆成每列一個 thread 反而比較慢
+async def _build_image_urls_async(image_keys: list) -> list:
+    cdn, expires, bucket = _image_url_settings()
+    urls = [_image_url_without_signing(key, cdn, expires, bucket) for key in image_keys]
+    misses = [key for key, url in zip(image_keys, urls) if url is _NOT_CACHED]
+    if not misses:
+        return urls
+
+    signed = iter(await asyncio.get_running_loop().run_in_executor(
+        app.state.sign_pool, _sign_image_urls, misses, expires, bucket,
+    ))
+    return [next(signed) if url is _NOT_CACHED else url for url in urls]
+
+async def _build_image_url_async(image_key: Optional[str]) -> Optional[str]:
+    return (await _build_image_urls_async([image_key]))[0]
+
+PRESIGN_WARM_LIMIT = 200 # 背景預先簽幾篇最新貼文的圖片
+
+def _warm_image_urls(image_keys: list) -> None:
+    for key in image_keys:
+        _build_image_url(key) # 結果會留在 _signed_urls 快取裡
+
+# 每進入一個新的 expires/2 秒區間，就把最新幾篇貼文的 presigned URL 先簽好
+# 這樣 list_posts 幾乎都是查快取，簽章成本跟請求量無關，最多就是 PRESIGN_WARM_LIMIT 個 URL
+async def _presign_refresher():
+    loop = asyncio.get_running_loop()
+    while True:
+        expires = int(os.getenv("VIEW_EXPIRES_IN", "3600"))
+        window = max(1, expires // 2)
+        try:
+            async with get_connection() as con:
+                async with con.cursor() as cur:
+                    await cur.execute(
+                        "SELECT image_key FROM posts WHERE image_key IS NOT NULL ORDER BY id DESC LIMIT %s",
+                        (PRESIGN_WARM_LIMIT,),
+                    )
+                    image_keys = [r[0] for r in await cur.fetchall()]
+            await loop.run_in_executor(app.state.sign_pool, _warm_image_urls, image_keys)
+        except Exception: # DB 暫時連不上之類的，下一輪再試；list_posts 遇到沒快取的還是會自己簽
+            logger.exception("presign refresh failed")
+
+        # 睡到下一個區間開始（多等 1 秒，確保醒來時 _url_bucket 已經換到新區間）
+        await asyncio.sleep(window - time.time() % window + 1)
 
 @app.post("/api/presign")
 def presign(data: PresignIn):
@@ -72,65 +206,93 @@ def presign(data: PresignIn):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Presign failed (S3 not ready): {e}")
     
-@app.post("/api/posts")
-def create_post(data: PostCreateIn):
-    con = get_connection()
-    try:
-        cur = con.cursor(dictionary=True)
-        cur.execute(
-            "INSERT INTO posts (message, image_key) VALUES (%s, %s)",
-            (data.message, data.image_key),
-        )
-        con.commit()
-        post_id = cur.lastrowid # 取得剛插入資料的自增主鍵 ID
-
-        cur.execute("SELECT id, message, image_key, created_at FROM posts WHERE id=%s", (post_id,))
-        row = cur.fetchone()
-        
-        print(_build_image_url(row.get("image_key")))
-
-        return {
-            "id": int(row["id"]),
-            "message": row["message"],
-            "image_url": _build_image_url(row.get("image_key")), # image_key 可能是 None，所以用 .get()
-            "created_at": row["created_at"].isoformat(),
-        }
-        
-    finally:
-        con.close()
+# MySQL 沒有 INSERT ... RETURNING，aiomysql 也不支援 server-side prepared statement，所以 SQL 固定成常數、一次 INSERT 就完成
+INSERT_POST_SQL = "INSERT INTO posts (message, image_key, created_at) VALUES (%s, %s, %s)"
+
+@app.post("/api/posts", response_model=PostOut)
+async def create_post(data: PostCreateIn):
+    # created_at 由這裡產生、一起寫進 DB，就不用 INSERT 後再 SELECT 一次把它讀回來
+    # 用 UTC（DB session 的 time_zone 也是 UTC），去掉微秒，跟 TIMESTAMP 欄位存的精度一致
+    created_at = datetime.now(timezone.utc).replace(microsecond=0)
+
+    async with get_connection() as con:
+        async with con.cursor() as cur: # 不需要讀回任何欄位，用一般 cursor 就好
+            await cur.execute(INSERT_POST_SQL, (data.message, data.image_key, created_at.replace(tzinfo=None))) # 寫進 DB 用不帶時區的 UTC 值
+            await con.commit()
+            post_id = cur.lastrowid # 取得剛插入資料的自增主鍵 ID
+    # 離開 async with 時連線已經還回連線池，簽 URL 的時候不會佔著 DB 連線
+
+    return {
+        "id": post_id,
+        "message": data.message,
+        "image_url": await _build_image_url_async(data.image_key), # image_key 可能是 None
+        "created_at": created_at,
+    }
+
+# 列表的 ETag：貼文只會新增（沒有編輯、刪除的 API），所以只要最新的 id 跟 limit 沒變，回傳內容就不會變
+# 沒串 CDN 時，presigned URL 每 expires/2 秒會換一次，所以把那個區間也算進去，避免前端拿到過期的圖片網址
+def _posts_etag(max_id, limit: int) -> str:
+    parts = f"{max_id}-{limit}"
+    if not os.getenv("CDN_DOMAIN", "").strip():
+        parts += f"-{_url_bucket(int(os.getenv('VIEW_EXPIRES_IN', '3600')))}"
+    return '"' + hashlib.sha256(parts.encode()).hexdigest() + '"' # 強 ETag（不加 W/ 前綴），值本身要用雙引號包起來
 
-@app.get("/api/posts")
-def list_posts(limit: int = 50):
+POSTS_CACHE_CONTROL = "public, max-age=5"
+
+# If-None-Match 要用弱比較（忽略 W/ 前綴），"*" 代表任何版本都算符合；跟 StaticFiles.is_not_modified 的判斷一樣
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+@app.get("/api/posts", response_model=PostListOut)
+async def list_posts(request: Request, response: Response, limit: int = 50):
     limit = max(1, min(limit, 100)) # 限制在 1–100 範圍內
 
-    con = get_connection()
-    try:
-        cur = con.cursor(dictionary=True)
-        cur.execute(
-            "SELECT id, message, image_key, created_at FROM posts ORDER BY created_at DESC LIMIT %s",
-            (limit,),
-        )
-        rows = cur.fetchall()
-
-        data = []
-        for r in rows:
-            data.append({
-                "id": int(r["id"]),
-                "message": r["message"],
-                "image_url": _build_image_url(r.get("image_key")),
-                "created_at": r["created_at"].isoformat(),
-            })
-        
-        return {"data": data}
-    finally:
-        con.close()
+    async with get_connection() as con:
+        async with con.cursor() as cur: # 一般 cursor 回傳 tuple，不用每一列都建一個 dict
+            # 先用很便宜的查詢算出 ETag，沒變就直接回 304，不用撈資料、組 JSON、簽 URL
+            # MAX(id) 只要讀主鍵的最後一筆；COUNT(*) 在 InnoDB 要掃整個索引，所以不用
+            await cur.execute("SELECT MAX(id) FROM posts")
+            (max_id,) = await cur.fetchone()
+            etag = _posts_etag(max_id, limit)
+
+            if _etag_matches(request.headers.get("if-none-match", ""), etag):
+                return Response(status_code=304, headers={"ETag": etag, "Cache-Control": POSTS_CACHE_CONTROL})
+
+            await cur.execute(
+                "SELECT id, message, image_key, created_at FROM posts ORDER BY id DESC LIMIT %s", # id 跟 created_at 一樣是遞增的，直接倒著走主鍵，不用整張表排序
+                (limit,),
+            )
+            rows = await cur.fetchall()
+    # 到這裡連線已經還回連線池，下面簽 URL 的時間不會佔著 DB 連線，其他請求可以先用
+
+    # 欄位順序跟 SELECT 一樣：id, message, image_key, created_at
+    image_urls = await _build_image_urls_async([r[2] for r in rows])
+    data = [
+        {
+            "id": r[0],
+            "message": r[1],
+            "image_url": image_url,
+            "created_at": r[3].replace(tzinfo=timezone.utc), # DB session 是 UTC，讀出來的 naive 值補上時區，前端才知道是 UTC
+        }
+        for r, image_url in zip(rows, image_urls)
+    ]
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = POSTS_CACHE_CONTROL
+    return {"data": data}
 
 # 冒煙測試用（容器、ALB、Nginx health check 都常用）
-@app.get("/health")
-def health_check():
-    return {"ok": True}
+# 探針打得很頻繁，所以直接掛 Starlette 的 Route、回傳寫死的 bytes，跳過 FastAPI 的參數解析跟 JSON 序列化
+HEALTH_BODY = b'{"ok":true}'
+
+async def health_check(request: Request) -> Response:
+    return Response(content=HEALTH_BODY, media_type="application/json")
+
+app.router.routes.insert(0, Route("/health", health_check, methods=["GET", "HEAD"], include_in_schema=False)) # 放在最前面，路由比對第一個就命中
 
 BASE_DIR = Path(__file__).resolve().parents[2] # ./msgboard
 WEB_DIR = BASE_DIR / "web" # ./msgboard/web
 
-app.mount("/", StaticFiles(directory=str(WEB_DIR), html=True), name="web") # directory="web"：指定靜態檔資料夾，是相對路徑，會以你啟動 uvicorn 時的工作目錄為基準；html=True：訪問 / 時會回傳 web/index.html
\ No newline at end of file
+app.mount("/", CachedStatic(directory=str(WEB_DIR), html=True), name="web") # directory="web"：指定靜態檔資料夾，是相對路徑，會以你啟動 uvicorn 時的工作目錄為基準；html=True：訪問 / 時會回傳 web/index.html
\ No newline at end of file
@@ -0,0 +1,15 @@
+# 一次性的資料庫初始化腳本：在啟動 uvicorn workers 之前先跑一次，避免多個 worker 同時建表
+# 用法（在 backend/ 底下）：python -m app.migrate
+import asyncio
+
+from .db import init_pool, close_pool, init_db
+
+async def main():
+    await init_pool()
+    try:
+        await init_db() # 如果表格已經存在就不會重建
+    finally:
+        await close_pool()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+import hashlib
+import os
+import re
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+# 檔名帶 hash 的資源（例如 app.3f9ab21c.js），內容變了檔名就會變，可以讓瀏覽器快取一年
+_FINGERPRINTED = re.compile(r"\.[0-9a-f]{8,}\.(js|css|png|jpg|svg)$")
+
+# 幫 StaticFiles 加上 Cache-Control，並把預設的 ETag（只看 mtime + size）換成用檔案內容算的 SHA-256 強 ETag
+class CachedStatic(StaticFiles):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._etags = {} # full_path -> (mtime, size, etag)，檔案沒改就不用重算 hash
+
+    def _strong_etag(self, full_path, stat_result: os.stat_result) -> str:
+        cached = self._etags.get(full_path)
+        if cached and cached[:2] == (stat_result.st_mtime, stat_result.st_size):
+            return cached[2]
+
+        with open(full_path, "rb") as f:
+            etag = '"' + hashlib.sha256(f.read()).hexdigest() + '"'
+        self._etags[full_path] = (stat_result.st_mtime, stat_result.st_size, etag)
+        return etag
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+
+        if _FINGERPRINTED.search(str(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            # index.html、app.js 這類檔名固定的檔案：每次都要跟 server 確認，沒變就回 304
+            response.headers["Cache-Control"] = "public, no-cache"
+            response.headers["ETag"] = self._strong_etag(full_path, stat_result)
+
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
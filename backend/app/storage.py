@@ -1,30 +1,50 @@
 import os
 import re
+import logging
+from functools import lru_cache
 from pathlib import Path # 處理路徑與檔名
 from uuid import uuid4 # 產生唯一 ID
-from dotenv import load_dotenv
 import boto3 # AWS SDK for Python，用於與 S3 互動
 from botocore.config import Config
 
-# 要確保真的能讀到 .env
-BASE_DIR = Path(__file__).resolve().parents[2]  # msgboard
-load_dotenv(BASE_DIR / ".env")
+# .env 已經在 app/__init__.py 載入過了
 
 S3_BUCKET = os.getenv("S3_BUCKET", "").strip() # 讀取 S3 bucket 名稱
 AWS_REGION = os.getenv("AWS_REGION", "ap-northeast-1").strip() # 讀取 AWS 區域設定
 
-_session = boto3.session.Session(region_name=AWS_REGION) # 建立一個 AWS session，明確控制使用的 AWS 區域
-_s3 = _session.client(
-    "s3",
-    config=Config(signature_version="s3v4", s3={"addressing_style": "virtual"}),
-    endpoint_url=f"https://s3-{AWS_REGION}.amazonaws.com",
-) # 從這個 session 產生一個 S3 client，之後所有 S3 API 都會走這個 client
+logger = logging.getLogger(__name__)
+
+# 啟動時先檢查 S3 設定，有缺就馬上在 log 警告，而不是等到第一個上傳請求才失敗
+# 只警告不擋啟動：S3 還沒建好時，留言板的文字功能還是要能用
+def check_config():
+    missing = [name for name, value in (("S3_BUCKET", S3_BUCKET), ("AWS_REGION", AWS_REGION)) if not value]
+    if missing:
+        logger.warning("%s not set; image upload and preview are disabled", ", ".join(missing))
+
+# 第一次用到才建立 S3 client，之後都重用同一個（測試時可以用 get_s3_client.cache_clear() 重建）
+@lru_cache(maxsize=1)
+def get_s3_client():
+    session = boto3.session.Session(region_name=AWS_REGION) # 建立一個 AWS session，明確控制使用的 AWS 區域
+    return session.client(
+        "s3",
+        config=Config(
+            signature_version="s3v4",
+            s3={"addressing_style": "virtual"},
+            max_pool_connections=50, # 預設只有 10 條，併發一高就會排隊等連線
+            tcp_keepalive=True, # 保持 TCP 連線，不用每次重新握手
+            retries={"mode": "adaptive", "max_attempts": 3},
+        ),
+        endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com", # 用 s3.<region> 的新格式，舊的 s3-<region> 已經 deprecated
+    ) # 從這個 session 產生一個 S3 client，之後所有 S3 API 都會走這個 client
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9._-]+") # 不是英數字、點、底線、減號的字元，模組載入時先編譯好
 
 # 把原始檔名清理成安全版本
 def _safe_filename(filename: str) -> str:
     name = Path(filename).name or "upload" # 把字串變成 Path 物件後，.name 會回傳最後的檔名；如果空就用 "upload"
-    name = re.sub(r"[^A-Za-z0-9._-]+", "_", name) # 把不是英數字、點、底線、減號的字元都換成底線
-    return name[:120] # 最長限制 120 字元
+    if _UNSAFE.search(name) is None: # 已經是安全的檔名就不用再替換
+        return name[:120] # 最長限制 120 字元
+    return _UNSAFE.sub("_", name)[:120] # 把不安全的字元都換成底線
 
 # 回傳「讓瀏覽器可以直接上傳到 S3」所需的資料
 def create_presigned_post(filename: str, content_type: str, *, max_bytes: int, expires_in: int): # 「*,」代表從這之後的參數都要用關鍵字參數傳入（一定要寫成 max_bytes=...、expires_in=...）
@@ -50,7 +70,7 @@ def create_presigned_post(filename: str, content_type: str, *, max_bytes: int, e
     ]
 
     # boto3 產生 presigned POST 所需資料
-    post = _s3.generate_presigned_post(
+    post = get_s3_client().generate_presigned_post(
         Bucket=S3_BUCKET, # 指定要上傳到哪個 bucket
         Key=key, # 指定 object key，S3 收到 POST 表單後，會用 key 這個欄位當作「物件路徑」存檔
         Fields=fields, # 除了希望的固定欄位，AWS 會混入自己需要的 policy、x-amz-* 等
@@ -71,7 +91,7 @@ def create_presigned_get(key: str, *, expires_in: int) -> str:
     if not S3_BUCKET:
         raise RuntimeError("S3_BUCKET is not set")
 
-    return _s3.generate_presigned_url(
+    return get_s3_client().generate_presigned_url(
         "get_object", # S3 的 GetObject 動作，產生一個「暫時可讀取/下載該檔案」的 URL，可以把它放到 <img src="..."> 讓圖片顯示
         Params={"Bucket": S3_BUCKET, "Key": key}, # 指定要讀取哪個 bucket、哪個 object key
         ExpiresIn=expires_in,
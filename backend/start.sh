@@ -0,0 +1,15 @@
+#!/bin/sh
+# 正式環境的啟動腳本：先做一次 DB 初始化，再用多個 uvicorn workers 吃滿所有 CPU 核心
+set -e
+
+python -m app.migrate
+
+# WEB_CONCURRENCY 沒設就用 2 * CPU 核心數 + 1
+# --preload：master 先 import 一次 app 再 fork，FastAPI / pydantic / boto3 的記憶體由各 worker 共用（copy-on-write）
+# DB 連線池在每個 worker 的 startup 才建立、S3 client 第一次用到才建立，所以不會有 fork 前建好的連線被共用
+# UvicornWorker 預設 loop / http 都是 auto，有裝 uvloop、httptools 就會自動用
+exec gunicorn app.main:app \
+    --worker-class uvicorn_worker.UvicornWorker \
+    --bind 0.0.0.0:8000 \
+    --workers "${WEB_CONCURRENCY:-$((2 * $(nproc) + 1))}" \
+    --preload